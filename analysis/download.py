@@ -6,26 +6,53 @@ This skips wcEcoli seed lines that failed before the requested number of sim
 generations. That can happen due to ODE solver instabilities. Turn on swap space
 so Out-Of-Memory won't cause sim failures.
 
+It skips sim files whose local copies match the stored files' sizes and blob
+generation numbers (recorded in GENERATION_SUFFIX sidecar files), so rerunning
+the script will fetch just the missing or changed ones.
+
 TODO(jerry): More error recovery, e.g. timeouts and more retries.
 
-TODO(jerry): Maybe skip downloads that would replace existing files so rerunning
-the script will fetch the missing ones. That assumes the GCS files haven't
-changed, or cross-check their blob generation numbers to handle that.
+TODO(jerry): Fetch the three tiny attributes.json files per simOut dir as one
+blob. An offline step could `gsutil compose` them into one blob per simOut dir
+plus a manifest of their offsets for splitting after download. That needs
+write access to the sim output bucket. (The GCS JSON API batch endpoint only
+batches metadata requests, not media downloads, so it can't fetch them.)
 """
 
-import concurrent.futures as cf
+import asyncio
 import json
+import logging
 import re
 import os
 import time
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set
+
+from tqdm import tqdm
+
+try:
+    # Optional, for async downloads.
+    # noinspection PyPackageRequirements
+    import gcsfs
+except ImportError:
+    gcsfs = None
 
-from analysis.storage import CloudStorage
+from analysis.storage import (
+    BlobMeta, CloudStorage, MAX_CONCURRENT_WRITES, SMALL_FILE_MAX_BYTES,
+    write_file)
 
 
+logger = logging.getLogger(__name__)
+
 VARIANT = 'wildtype_000000'
 METADATA_PATHNAME = os.path.join('metadata', 'metadata.json')
 SIMDATA_MODIFIED_SUBPATH = os.path.join('kb', 'simData_Modified.cPickle')
+SEED_DIRS_CACHE_DIR = 'seed_dirs_cache'
+GENERATION_SUFFIX = '.gen'  # sidecar file of a download's blob generation
+
+#: Matches a VARIANT/SEED/ subpath at the start of a sim output path.
+SEED_DIR_RE = re.compile(r'(.*?)generation_\d{6}')
+
+ASYNC_BATCH_SIZE = 128  # max concurrent async downloads
 
 SIM_FILES = [
     'Mass/attributes.json',
@@ -38,16 +65,6 @@ SIM_FILES = [
 ]
 
 
-def removeprefix(string: str, prefix: str) -> str:
-    """Like string.removeprefix(prefix) in Python 3.9."""
-    return string[len(prefix):] if string.startswith(prefix) else string
-
-
-def removesuffix(string: str, suffix: str) -> str:
-    """Like string.removesuffix(suffix) in Python 3.9."""
-    return string[:-len(suffix)] if string.endswith(suffix) else string
-
-
 class DownloadSims:
     """Downloader for the needed files of relevant simOut/ dirs."""
 
@@ -55,132 +72,357 @@ class DownloadSims:
                  bucket: str,
                  wcm_workflow_name: str,
                  variant_name: str = VARIANT,
-                 local_dir: str = '') -> None:
+                 local_dir: str = '',
+                 use_grpc: bool = False,
+                 storage: Optional[CloudStorage] = None,
+                 refresh: bool = False,
+                 progress_position: int = 0,
+                 shared_files: bool = True) -> None:
         """Construct a WCM sim downloader.
         Args:
             bucket: GCS storage bucket.
             wcm_workflow_name: WCM/<workflow> name.
             variant_name: WCM variant; default = 'wildtype_000000'.
             local_dir: the local directory path to download into.
+            use_grpc: download single small files (metadata.json and the
+                serial retries) via the GCS gRPC API, if this makes its own
+                CloudStorage. The bulk downloads still use the JSON API.
+            storage: a CloudStorage accessor for the bucket to share across
+                downloaders, otherwise this makes one.
+            refresh: re-list the successful seed dirs rather than reading them
+                from the local cache file.
+            progress_position: the terminal line offset for this downloader's
+                progress bar, to keep concurrent downloaders' bars apart.
+            shared_files: download the files that downloaders into the same
+                local_dir have in common, metadata.json and
+                simData_Modified.cPickle. Only one of them should, so the
+                local copies don't depend on which one finishes last.
         """
-        storage_prefix = os.path.join(bucket, 'WCM', wcm_workflow_name)
+        # The workflow's path prefix within the bucket.
+        self.storage_prefix = os.path.join('WCM', wcm_workflow_name, '')
+        self.workflow_name = wcm_workflow_name
         self.variant_name = variant_name
+        self.refresh = refresh
+        self.progress_position = progress_position
+        self.shared_files = shared_files
         self.local_dir = os.path.join(local_dir or wcm_workflow_name, '')
 
-        self.storage = CloudStorage(storage_prefix)
+        self.storage = storage or CloudStorage(bucket, use_grpc=use_grpc)
         self.simout_dirs: List[str] = []
 
         self.queue: Dict[str, bool] = {}  # ordered queue of paths to download
+        self.blob_meta: Dict[str, BlobMeta] = {}  # stored sim files by path
         self.count = 0
+        self.skipped = 0
 
         # later: download metadata.json and read these fields
         self.generations = 0
         self.init_sims = 0
         self.seed = 0
 
-    def download_file(self, relative_path: str):
+    def download_file(self, relative_path: str, parent_exists: bool = False,
+                      small: bool = True):
         """Download a file from the relative_path (relative to storage_prefix)
         to the same path (relative to the local_dir), and return the local path.
+        `small=True` skips checksum validation. Raise OSError if the download
+        fails.
         """
         local_path = os.path.join(self.local_dir, relative_path)
-        self.storage.download_file(relative_path, local_path)
+        if not self.storage.download_file(
+                self.storage_prefix + relative_path, local_path, small=small,
+                parent_exists=parent_exists):
+            raise OSError(f'Failed to download {relative_path}')
         self.count += 1
-        print(f'Downloaded: {relative_path}')
+        logger.debug('Downloaded: %s', relative_path)
         return local_path
 
-    def queue_files(self, sub_dir: str, relative_paths: List[str]) -> None:
-        """Queue the given list of files to download from/to a sub_dir."""
-        for p in relative_paths:
-            self.queue[os.path.join(sub_dir, p)] = True
+    def queue_files(self, paths: Iterable[str]) -> None:
+        """Queue the given files to download, skipping those already
+        downloaded."""
+        for path in paths:
+            if self.needs_download(path):
+                self.queue[path] = True
+            else:
+                self.skipped += 1
+
+    def list_sim_files_meta(self) -> None:
+        """List the metadata of all the stored SIM_FILES into self.blob_meta."""
+        glob = os.path.join(
+            self.variant_name, '0*', 'generation_*', '000000', 'simOut',
+            '{' + ','.join(SIM_FILES) + '}')
+        listing = self.storage.list_blobs_with_meta(
+            self.storage_prefix + os.path.join(self.variant_name, ''),
+            match_glob=self.storage_prefix + glob)
+        self.blob_meta = {
+            meta.name.removeprefix(self.storage_prefix): meta
+            for meta in listing}
+
+    def is_small(self, path: str) -> bool:
+        """Return True if the listed file at path is small enough to download
+        without checksum validation."""
+        meta = self.blob_meta.get(path)
+        return meta is not None and meta.size <= SMALL_FILE_MAX_BYTES
+
+    def needs_download(self, path: str) -> bool:
+        """Return True unless the local copy of the file at path matches its
+        listed size and blob generation."""
+        meta = self.blob_meta.get(path)
+        if meta is None:
+            return True
+
+        local_path = os.path.join(self.local_dir, path)
+        try:
+            if os.stat(local_path).st_size != meta.size:
+                return True
+            with open(local_path + GENERATION_SUFFIX) as f:
+                return int(f.read()) != meta.generation
+        except (OSError, ValueError):
+            return True
+
+    def dequeue(self, completed: Set[str]) -> None:
+        """Remove the successfully downloaded paths from the queue in one pass
+        and record their blob generations in sidecar files."""
+        self.queue = {p: True for p in self.queue if p not in completed}
+
+        for path in completed:
+            self.record_generation(path)
+
+    def record_generation(self, path: str) -> None:
+        """Record the downloaded file's listed blob generation, if any, in its
+        sidecar file."""
+        meta = self.blob_meta.get(path)
+        if meta is not None:
+            local_path = os.path.join(self.local_dir, path)
+            write_file(local_path + GENERATION_SUFFIX,
+                       str(meta.generation).encode())
+
+    def make_local_dirs(self) -> None:
+        """Make the local directories for all the queued files, once per
+        directory rather than once per file."""
+        for local_dir in {os.path.dirname(os.path.join(self.local_dir, p))
+                          for p in self.queue}:
+            os.makedirs(local_dir, exist_ok=True)
 
     def serial_download(self) -> None:
-        """Download the queued files in series. Remove successes from the queue."""
-        queue = dict(self.queue)
-
-        for path in queue:
+        """Download the queued files in series. Remove successes from the queue.
+        The local dirs must already exist; see make_local_dirs()."""
+        pending = list(self.queue)
+        if not pending:
+            return
+        completed: Set[str] = set()
+
+        for path in tqdm(pending, desc=self.workflow_name, unit='file',
+                         position=self.progress_position):
             try:
-                self.download_file(path)
+                self.download_file(
+                    path, parent_exists=True, small=self.is_small(path))
             except Exception as e:
-                print(f'Download failed: {path}: {e!r}')
+                logger.warning('Download failed: %s: %r', path, e)
             else:
-                del self.queue[path]
+                completed.add(path)
 
-    def parallel_download(self) -> None:
-        """Download the queued files in parallel. Remove successes from the queue."""
-        fn = self.download_file
+        self.dequeue(completed)
 
-        with cf.ThreadPoolExecutor(thread_name_prefix='Downloader-') as executor:
-            future_to_path = {executor.submit(fn, path): path for path in self.queue}
+    def dequeue_successes(self, paths: Sequence[str],
+                          results: Sequence[Optional[BaseException]]) -> None:
+        """Remove the successfully downloaded paths from the queue given their
+        results, None for success or an exception for failure."""
+        completed = {path for path, result in zip(paths, results) if result is None}
+        self.count += len(completed)
+        self.dequeue(completed)
 
-            for future in cf.as_completed(future_to_path):
-                path = future_to_path[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f'Download failed: {path}: {e!r}')
-                else:
-                    del self.queue[path]
+        print(f'  Downloaded {len(completed)} files in parallel,'
+              f' {len(paths) - len(completed)} failed')
 
-    def download_metadata(self) -> int:
-        """Download the workflow output's metadata.json file, read fields, and
-        return its number of generations."""
-        local_path = self.download_file(METADATA_PATHNAME)
+    def parallel_download(self) -> None:
+        """Download the queued files in parallel via the GCS transfer manager,
+        which manages the worker threads and connection reuse. Only the small
+        files skip checksum validation. Remove successes from the queue."""
+        small_paths = [path for path in self.queue if self.is_small(path)]
+        large_paths = [path for path in self.queue if not self.is_small(path)]
+
+        with tqdm(total=len(self.queue), desc=self.workflow_name, unit='file',
+                  position=self.progress_position) as progress:
+            results = (
+                self.storage.download_files(
+                    small_paths, self.local_dir, prefix=self.storage_prefix,
+                    small=True, parent_exists=True, callback=progress.update)
+                + self.storage.download_files(
+                    large_paths, self.local_dir, prefix=self.storage_prefix,
+                    parent_exists=True, callback=progress.update))
+        self.dequeue_successes(small_paths + large_paths, results)
+
+    async def _async_download_all(self) -> None:
+        """Download the queued files concurrently via asyncio and gcsfs, which
+        handles connection pooling and retries over one aiohttp session. Remove
+        successes from the queue. Only MAX_CONCURRENT_WRITES files get written
+        at once, and each fetch holds its ASYNC_BATCH_SIZE slot until its file
+        is written, which bounds the file contents buffered in memory."""
+        prefix = os.path.join(
+            self.storage.bucket_name,
+            self.storage.path_prefix + self.storage_prefix)
+        semaphore = asyncio.Semaphore(ASYNC_BATCH_SIZE)
+        write_semaphore = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+        loop = asyncio.get_running_loop()
+
+        # skip_instance_cache since an async instance is bound to this loop.
+        fs = gcsfs.GCSFileSystem(asynchronous=True, skip_instance_cache=True)
+
+        paths = list(self.queue)
+        progress = tqdm(total=len(paths), desc=self.workflow_name, unit='file',
+                        miniters=max(1, len(paths) // 100),
+                        position=self.progress_position)
+
+        async def sem_download(path: str) -> None:
+            try:
+                async with semaphore:
+                    data = await fs._cat_file(prefix + path)
+                    async with write_semaphore:
+                        await loop.run_in_executor(
+                            None, write_file, os.path.join(self.local_dir, path),
+                            data)
+                logger.debug('Downloaded: %s', path)
+            finally:
+                progress.update()
+
+        session = await fs._set_session()
+        try:
+            results = await asyncio.gather(
+                *[sem_download(path) for path in paths], return_exceptions=True)
+        finally:
+            await session.close()
+            progress.close()
+
+        self.dequeue_successes(paths, results)
 
-        with open(local_path) as fp:
-            metadata = json.load(fp)
-            self.generations = metadata['generations']
-            self.init_sims = metadata['init_sims']
-            self.seed = metadata['seed']
+    def download_metadata(self) -> int:
+        """Read the workflow output's metadata.json file, save it if
+        self.shared_files, read fields, and return its number of generations.
+        Raise OSError if the download fails."""
+        data = self.storage.read_file(self.storage_prefix + METADATA_PATHNAME)
+        if data is None:
+            raise OSError(f'Failed to download {METADATA_PATHNAME}')
+
+        if self.shared_files:
+            local_path = os.path.join(self.local_dir, METADATA_PATHNAME)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            write_file(local_path, data)
+            self.count += 1
+            logger.debug('Downloaded: %s', METADATA_PATHNAME)
+
+        metadata = json.loads(data)
+
+        self.generations = metadata['generations']
+        self.init_sims = metadata['init_sims']
+        self.seed = metadata['seed']
 
         return self.generations
 
     def download_simdata_modified(self):
-        """Download the variant's simData_Modified.cPickle."""
+        """Download the variant's simData_Modified.cPickle. It's large enough
+        to benefit from a sliced download. On failure, retry it as one
+        checksummed stream rather than via the small-file queue. Skip it if
+        the local copy matches the stored file's size and blob generation."""
         path = os.path.join(self.variant_name, SIMDATA_MODIFIED_SUBPATH)
-        self.download_file(path)
-
-    def find_successful_seed_dirs(self, max_gen: int):
-        """Find all VARIANT/SEED/ subpaths (e.g. 'wildtype_000000/000001/') with
-        simulations that succeeded through generation max_gen (e.g. 31).
+        local_path = os.path.join(self.local_dir, path)
+
+        meta = self.storage.get_blob_meta(self.storage_prefix + path)
+        if meta is not None:
+            self.blob_meta[path] = meta
+            if not self.needs_download(path):
+                self.skipped += 1
+                return
+
+        ok = (self.storage.download_file_sliced(
+                  self.storage_prefix + path, local_path)
+              or self.storage.download_file(
+                  self.storage_prefix + path, local_path))
+
+        if ok:
+            self.record_generation(path)
+            self.count += 1
+            logger.debug('Downloaded: %s', path)
+        else:
+            logger.warning('Download failed: %s', path)
+
+    def find_successful_seed_dirs(self, max_gen: int) -> Iterator[str]:
+        """Generate all VARIANT/SEED/ subpaths (e.g. 'wildtype_000000/000001/')
+        with simulations that succeeded through generation max_gen (e.g. 31).
+
+        Cache a non-empty result in a local JSON file keyed by workflow and
+        max_gen, and read that on later runs unless self.refresh. (An empty
+        result might come from a listing problem or a workflow that's still
+        running, so don't pin it.)
+        """
+        cache_path = os.path.join(
+            self.local_dir, SEED_DIRS_CACHE_DIR,
+            f'{self.workflow_name}__gen_{max_gen:06d}.json')
+        if not self.refresh and os.path.exists(cache_path):
+            with open(cache_path) as fp:
+                yield from json.load(fp)
+            return
+
+        seed_dirs = []
+        for seed_dir in self.list_successful_seed_dirs(max_gen):
+            seed_dirs.append(seed_dir)
+            yield seed_dir
+
+        if seed_dirs:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            write_file(cache_path, json.dumps(seed_dirs, indent=2).encode())
+
+    def list_successful_seed_dirs(self, max_gen: int) -> Iterator[str]:
+        """Generate the VARIANT/SEED/ subpaths with simulations that succeeded
+        through generation max_gen as a server-filtered listing streams in.
         """
-        # List storage paths 'VARIANT/0*' to find seed subdirs up to '099999'.
-        # '0' skips the '/' dir itself and its subdirs like 'kb/'.
-        seed_0_star = os.path.join(self.variant_name, '0')
-        prefix = self.storage.path_prefix
-        seed_paths = [removeprefix(blob.name, prefix) for blob in
-                      self.storage.list_blobs(seed_0_star, star=True)]
-
-        # Find the seed subdirs that successfully wrote last-generation output.
+        # Glob for the marker file that each seed subdir writes upon successful
+        # last-generation output. 'VARIANT/0*/' covers seed subdirs up to
+        # '099999' and skips subdirs like 'kb/'.
         marker = os.path.join(
             f'generation_{max_gen:06d}', '000000', 'simOut',
             'Daughter1_inherited_state.cPickle')
-        iterators = [self.storage.list_blobs(os.path.join(seed, marker))
-                     for seed in seed_paths]
+        glob = os.path.join(self.storage_prefix, self.variant_name, '0*', marker)
+        prefix = self.storage.path_prefix + self.storage_prefix
 
         # Extract the VARIANT/SEED/ subpaths.
-        r = re.compile(re.escape(prefix) + r'(.*)generation_\d{6}')
-        dirs = [[r.match(b.name)[1] for b in it] for it in iterators]
-        return sum(dirs, [])  # flatten
+        return (SEED_DIR_RE.match(blob.name.removeprefix(prefix)).group(1)
+                for blob in self.storage.list_blobs(
+                    os.path.join(self.storage_prefix, self.variant_name, ''),
+                    match_glob=glob))
 
     def download_all_needed_files(self) -> int:
         """Download all the needed files from this WCM workflow.
         Returns the count of files downloaded."""
         start_secs = time.monotonic()
-        print(f'Downloading from {self.storage.url()} to {self.local_dir}')
+        print(f'Downloading from {self.storage.url(self.storage_prefix)}'
+              f' to {self.local_dir}')
 
         generations = self.download_metadata()
         print(f'  {generations=}')
 
-        self.queue_files(self.variant_name, [SIMDATA_MODIFIED_SUBPATH])
-
-        seed_dirs = self.find_successful_seed_dirs(generations - 1)
-        for seed_dir in seed_dirs:
-            for gen in range(generations):
-                sim_out = os.path.join(
-                    seed_dir, f'generation_{gen:06d}', '000000', 'simOut')
-                self.queue_files(sim_out, SIM_FILES)
-
-        self.parallel_download()
+        if self.shared_files:
+            self.download_simdata_modified()
+
+        # List the stored sim files' metadata up front, then enqueue each
+        # successful seed's files that need downloading as that seed listing
+        # streams in (or comes from the cache).
+        self.list_sim_files_meta()
+        gen_suffixes = [
+            os.path.join(f'generation_{gen:06d}', '000000', 'simOut', '')
+            for gen in range(generations)]
+        self.queue_files(
+            seed_dir + gen_suffix + sim_file
+            for seed_dir in self.find_successful_seed_dirs(generations - 1)
+            for gen_suffix in gen_suffixes
+            for sim_file in SIM_FILES)
+        print(f'  Queued {len(self.queue)} files, skipped {self.skipped}'
+              f' already downloaded')
+
+        self.make_local_dirs()
+        if gcsfs is None:
+            self.parallel_download()
+        else:
+            asyncio.run(self._async_download_all())
         self.serial_download()  # retry any failures serially
         # TODO(jerry): More retries?
 
@@ -1,17 +1,52 @@
 """Interface to Google Cloud Storage (GCS)."""
 
+import io
 import logging
 import os
-from typing import Iterator, List, Optional, Set
+import threading
+from typing import (
+    Callable, Iterator, List, NamedTuple, Optional, Sequence, Set)
 
 # noinspection PyPackageRequirements
-from google.cloud.storage import Blob, Client
+import google.auth
+# noinspection PyPackageRequirements
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# noinspection PyPackageRequirements
+from google.cloud.storage import Blob, Client, transfer_manager
 # noinspection PyPackageRequirements
 from google.cloud.exceptions import GoogleCloudError, PreconditionFailed
+# noinspection PyPackageRequirements
+from google.cloud.storage.exceptions import DataCorruption
 
 
 OCTET_STREAM = 'application/octet-stream'
 
+#: The slice size for download_file_sliced().
+SLICE_SIZE = 32 * 1024 * 1024
+
+#: Files up to this size are small enough to download without checksum
+#: validation. See CloudStorage.SMALL_DOWNLOAD_KWARGS.
+SMALL_FILE_MAX_BYTES = 8 * 1024 * 1024
+
+#: The filename suffix for a partially downloaded file.
+PART_SUFFIX = '.part'
+
+#: Local disk write budget and typical downloaded file size, which determine
+#: MAX_CONCURRENT_WRITES. Past that, concurrent writers just slow each other.
+IO_BUDGET_MBPS = 200
+AVG_FILE_MB = 25
+MAX_CONCURRENT_WRITES = max(1, IO_BUDGET_MBPS // AVG_FILE_MB)
+
+
+class BlobMeta(NamedTuple):
+    """Metadata of a stored file, named relative to a storage_prefix."""
+    name: str
+    size: int
+    generation: int
+    crc32c: str
+
 
 def bucket_path(pathname):
     # type: (str) -> List[str]
@@ -26,6 +61,47 @@ def bucket_path(pathname):
     return parts
 
 
+def write_file(local_path, data):
+    # type: (str, bytes) -> None
+    """Write data to local_path via a PART_SUFFIX temporary file and a rename,
+    so an interrupted run won't leave a partial file at local_path.
+    """
+    part_path = local_path + PART_SUFFIX
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    os.replace(part_path, local_path)
+
+
+def remove_file(local_path):
+    # type: (str) -> None
+    """Remove the file at local_path if it exists."""
+    try:
+        os.remove(local_path)
+    except FileNotFoundError:
+        pass
+
+
+def make_client(pool_size=64):
+    # type: (int) -> Client
+    """Make a GCS Client whose HTTP session keeps a pool of up to pool_size
+    connections per host and retries failed connections with backoff. Share
+    one Client among CloudStorage instances to reuse its connections and save
+    TLS handshakes and auth token fetches.
+
+    The pool serves the threads in one process, including the transfer
+    manager's THREAD workers. A Client isn't picklable, so each process (e.g.
+    each download_all() branch) needs its own.
+    """
+    credentials, project = google.auth.default(scopes=Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=5, backoff_factor=0.3))
+    session.mount('https://', adapter)
+    return Client(project=project, credentials=credentials, _http=session)
+
+
 def names_a_directory(path):
     # type: (str) -> bool
     """Return True if the given path names a directory vs. a file (even on GCS,
@@ -75,8 +151,21 @@ class CloudStorage(object):
     #: Needs 'nextPageToken' to iterate through all the entries.
     FIELDS = 'items(bucket,name,id,generation,size),nextPageToken'
 
-    def __init__(self, storage_prefix):
-        # type: (str) -> None
+    #: The Blob metadata fields for list_blobs_with_meta().
+    META_FIELDS = 'items(name,size,generation,crc32c),nextPageToken'
+
+    #: Download options for small files: fetch the body in one GET without
+    #: decompression or checksum validation, which costs more than it's worth
+    #: on tiny files.
+    SMALL_DOWNLOAD_KWARGS = {
+        'raw_download': True, 'single_shot_download': True, 'checksum': None}
+
+    #: Bounds the number of threads writing downloaded files at once while
+    #: letting their network fetches proceed concurrently.
+    _write_sem = threading.Semaphore(MAX_CONCURRENT_WRITES)
+
+    def __init__(self, storage_prefix, use_grpc=False, client=None):
+        # type: (str, bool, Optional[Client]) -> None
         """Construct a GCS accessor with the given storage_prefix, which must
         name a GCS bucket and optionally a base path, e.g.
         'curie-workflows/sim/2020-02-02/'. (It should end with a '/' but will
@@ -88,6 +177,14 @@ class CloudStorage(object):
         entries, which are empty objects with names ending in '/'. GCS doesn't
         require them but they make gcsfuse-mounted volumes 10x faster (gcsfuse
         without the `--implicit-dirs` option).
+
+        use_grpc makes read_file() and single-file download_file(small=True)
+        calls use the GCS gRPC API, which multiplexes requests over an HTTP/2
+        connection for lower per-request latency. Other operations, including
+        the bulk download_files(), use the JSON API. This needs the
+        `google-cloud-storage[grpc]` extra.
+
+        client is a GCS Client to share, otherwise this calls make_client().
         """
         self.bucket_name, self.path_prefix = bucket_path(storage_prefix)
         self.path_prefix = os.path.join(self.path_prefix, '')
@@ -96,8 +193,13 @@ class CloudStorage(object):
             # exists, but it trips over an empty name.
             raise ValueError("Invalid bucket name: '{}'".format(self.bucket_name))
 
-        self.client = Client()
+        self.client = client or make_client()
         self.bucket = self.client.get_bucket(self.bucket_name)
+        self.grpc_client = None
+        if use_grpc:
+            # noinspection PyPackageRequirements
+            from google.cloud.storage.grpc_client import GrpcClient
+            self.grpc_client = GrpcClient().grpc_client
 
         #: A cache of directory placeholders already created or verified.
         self._directory_cache = set()  # type: Set[str]
@@ -115,8 +217,8 @@ class CloudStorage(object):
         """Clear the cache of directory placeholder names already created."""
         self._directory_cache = set()
 
-    def list_blobs(self, prefix='', star=False):
-        # type: (str, bool) -> Iterator[Blob]
+    def list_blobs(self, prefix='', star=False, match_glob=None):
+        # type: (str, bool, Optional[str]) -> Iterator[Blob]
         """List Blobs that have the given prefix string with optional '*' glob.
 
         Arguments:
@@ -133,19 +235,65 @@ class CloudStorage(object):
                 If `prefix` ends with a '/', this will list it (if it exists as
                 a "dir") along with its immediate "files" and "subdirs".
 
+            match_glob: An optional GCS glob pattern appended to storage_prefix
+                for the server to filter the listing, e.g. 'a/*/b.txt'. See
+                https://cloud.google.com/storage/docs/json_api/v1/objects/list
+
         Returns:
             a Blob Iterator. For speed, each Blob has a subset of the possible
                 fields.
         """
         prefix = os.path.join(self.path_prefix, prefix)
+        if match_glob is not None:
+            match_glob = os.path.join(self.path_prefix, match_glob)
         iterator = self.client.list_blobs(
             self.bucket,
             prefix=prefix,
             fields=self.FIELDS,
             delimiter=os.sep if star else None,
-            include_trailing_delimiter=True if star else None)
+            include_trailing_delimiter=True if star else None,
+            match_glob=match_glob)
         return iterator
 
+    def list_blobs_with_meta(self, prefix='', match_glob=None):
+        # type: (str, Optional[str]) -> Iterator[BlobMeta]
+        """List the metadata of files that have the given prefix string and
+        optional match_glob (see list_blobs()) in one paged listing, naming each
+        file relative to the storage_prefix.
+        """
+        prefix = os.path.join(self.path_prefix, prefix)
+        if match_glob is not None:
+            match_glob = os.path.join(self.path_prefix, match_glob)
+        iterator = self.client.list_blobs(
+            self.bucket,
+            prefix=prefix,
+            fields=self.META_FIELDS,
+            match_glob=match_glob)
+
+        start = len(self.path_prefix)
+        for blob in iterator:
+            yield BlobMeta(
+                blob.name[start:], blob.size, blob.generation, blob.crc32c)
+
+    def get_blob_meta(self, sub_path):
+        # type: (str) -> Optional[BlobMeta]
+        """Get the metadata of the GCS file named sub_path (relative to the
+        storage_prefix) via one metadata GET.
+
+        Return None if the file is missing or the request failed. Logs
+        exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        try:
+            blob = self.bucket.get_blob(full_path)
+        except (GoogleCloudError, OSError) as _:
+            logging.exception('Failed to get GCS "%s" metadata', full_path)
+            return None
+
+        if blob is None:
+            return None
+        return BlobMeta(sub_path, blob.size, blob.generation, blob.crc32c)
+
     def make_dirs(self, sub_path):
         # type: (str) -> None
         """Make sub_path's directory placeholders if they don't exist. E.g. for
@@ -220,10 +368,13 @@ class CloudStorage(object):
         return ok
 
     @classmethod
-    def download_blob(cls, blob, local_path):
-        # type: (Blob, str) -> bool
+    def download_blob(cls, blob, local_path, small=False, parent_exists=False):
+        # type: (Blob, str, bool, bool) -> bool
         """Download a Blob from GCS as (not into) local_path, making directories
-        if needed. `blob` must have its `name` and `bucket` fields set.
+        if needed unless parent_exists. `blob` must have its `name` and `bucket`
+        fields set. `small=True` uses SMALL_DOWNLOAD_KWARGS and fetches the file
+        into memory before writing it, to throttle just the disk writes. The
+        file gets written via a PART_SUFFIX temporary file.
 
         Return True if successful. Logs exceptions.
         """
@@ -231,27 +382,200 @@ class CloudStorage(object):
             os.makedirs(local_path, exist_ok=True)
             return True
 
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        if not parent_exists:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
 
         try:
-            blob.download_to_filename(local_path)
-        except GoogleCloudError as _:
+            if small:
+                data = blob.download_as_bytes(**cls.SMALL_DOWNLOAD_KWARGS)
+                with cls._write_sem:
+                    write_file(local_path, data)
+            else:
+                part_path = local_path + PART_SUFFIX
+                try:
+                    blob.download_to_filename(part_path)
+                except BaseException:
+                    remove_file(part_path)
+                    raise
+                os.replace(part_path, local_path)
+        except (GoogleCloudError, DataCorruption, OSError) as _:
             logging.exception(
                 'Failed to download GCS "%s" as "%s"', blob.name, local_path)
             return False
 
         return True
 
-    def download_file(self, sub_path, local_path):
-        # type: (str, str) -> bool
+    def download_file(self, sub_path, local_path, small=False, parent_exists=False):
+        # type: (str, str, bool, bool) -> bool
         """Download the GCS file named sub_path (relative to the storage_prefix)
-        as (not into) the local_path, making local directories if needed.
+        as (not into) the local_path, making local directories if needed unless
+        parent_exists. `small=True` skips checksum validation for small files
+        and uses the gRPC API if enabled, which fetches into memory.
 
         Return True if successful. Logs exceptions.
         """
         full_path = os.path.join(self.path_prefix, sub_path)
+        if (small and self.grpc_client is not None
+                and not names_a_directory(local_path)):
+            return self._download_grpc(full_path, local_path, parent_exists)
+
         blob = self.bucket.blob(full_path)
-        return self.download_blob(blob, local_path)
+        return self.download_blob(
+            blob, local_path, small=small, parent_exists=parent_exists)
+
+    def read_file(self, sub_path):
+        # type: (str) -> Optional[bytes]
+        """Read the small GCS file named sub_path (relative to the
+        storage_prefix) into memory using SMALL_DOWNLOAD_KWARGS, or the gRPC
+        API if enabled.
+
+        Return its contents, or None if it failed. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        try:
+            if self.grpc_client is not None:
+                return self._read_grpc(full_path)
+            return self.bucket.blob(full_path).download_as_bytes(
+                **self.SMALL_DOWNLOAD_KWARGS)
+        except (GoogleCloudError, OSError) as _:
+            logging.exception('Failed to read GCS "%s"', full_path)
+            return None
+
+    def _read_grpc(self, full_path):
+        # type: (str) -> bytes
+        """Read the GCS object full_path into memory via the gRPC API."""
+        responses = self.grpc_client.read_object(
+            bucket='projects/_/buckets/' + self.bucket_name,
+            object_=full_path)
+        return b''.join(r.checksummed_data.content for r in responses)
+
+    def _download_grpc(self, full_path, local_path, parent_exists=False):
+        # type: (str, str, bool) -> bool
+        """Download the GCS object full_path via the gRPC API as (not into)
+        local_path, making directories if needed unless parent_exists.
+
+        Return True if successful. Logs exceptions.
+        """
+        if not parent_exists:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        try:
+            data = self._read_grpc(full_path)
+            with self._write_sem:
+                write_file(local_path, data)
+        except GoogleCloudError as _:
+            logging.exception(
+                'Failed to download GCS "%s" as "%s"', full_path, local_path)
+            return False
+
+        return True
+
+    def download_file_sliced(self, sub_path, local_path, components=16):
+        # type: (str, str, int) -> bool
+        """Download the GCS file named sub_path (relative to the storage_prefix)
+        as (not into) the local_path, making local directories if needed. This
+        fetches 32 MB slices via HTTP Range requests in up to `components`
+        worker threads, which is much faster than a single stream for a
+        large file. The file gets written via a PART_SUFFIX temporary file.
+
+        Return True if successful. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        blob = self.bucket.blob(full_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        part_path = local_path + PART_SUFFIX
+        try:
+            transfer_manager.download_chunks_concurrently(
+                blob,
+                part_path,
+                chunk_size=SLICE_SIZE,
+                max_workers=components,
+                worker_type=transfer_manager.THREAD)
+            os.replace(part_path, local_path)
+        except (GoogleCloudError, DataCorruption, OSError) as _:
+            # OSError covers requests' connection errors.
+            logging.exception(
+                'Failed to download GCS "%s" as "%s"', full_path, local_path)
+            remove_file(part_path)
+            return False
+
+        return True
+
+    def download_files(self, sub_paths, local_dir, prefix='', max_workers=32,
+                       small=False, parent_exists=False, batch_size=128,
+                       callback=None):
+        # type: (Sequence[str], str, str, int, bool, bool, int, Optional[Callable[[int], None]]) -> List[Optional[Exception]]
+        """Download the GCS files named by sub_paths (relative to the
+        storage_prefix + prefix) to the same relative paths in local_dir, making
+        local directories as needed unless parent_exists. This uses the GCS
+        transfer manager to fan out over max_workers worker threads. (Worker
+        processes would fork from the callers' workflow threads, risking
+        deadlocks, and multiply the process count.)
+
+        `small=True` uses SMALL_DOWNLOAD_KWARGS and fetches batch_size files at
+        a time into memory, then writes them under _write_sem, which bounds the
+        buffered bytes and the concurrent disk writes. Otherwise the files
+        stream to disk in at most MAX_CONCURRENT_WRITES worker threads. Either
+        way, each file gets written via a PART_SUFFIX temporary file.
+
+        If given, callback(n) gets called as each batch of n files finishes,
+        e.g. to update a progress bar.
+
+        Return a list of results in sub_paths order: None for each success or
+        the Exception for each failure.
+        """
+        sub_paths = list(sub_paths)
+        blob_prefix = self.path_prefix + prefix
+        if not small:
+            max_workers = min(max_workers, MAX_CONCURRENT_WRITES)
+        results = []  # type: List[Optional[Exception]]
+
+        for start in range(0, len(sub_paths), batch_size):
+            batch = sub_paths[start:start + batch_size]
+            local_paths = [os.path.join(local_dir, path) for path in batch]
+            if not parent_exists:
+                for local_subdir in {os.path.dirname(p) for p in local_paths}:
+                    os.makedirs(local_subdir, exist_ok=True)
+
+            if small:
+                targets = [io.BytesIO() for _ in batch]
+            else:
+                targets = [path + PART_SUFFIX for path in local_paths]
+            batch_results = transfer_manager.download_many(
+                [(self.bucket.blob(blob_prefix + path), target)
+                 for path, target in zip(batch, targets)],
+                # A copy since download_many() adds a 'command' entry to it.
+                download_kwargs=dict(self.SMALL_DOWNLOAD_KWARGS) if small else None,
+                max_workers=max_workers,
+                worker_type=transfer_manager.THREAD)
+
+            if small:
+                for local_path, buffer, result in zip(
+                        local_paths, targets, batch_results):
+                    if result is None:
+                        try:
+                            with self._write_sem:
+                                write_file(local_path, buffer.getvalue())
+                        except OSError as e:
+                            result = e
+                    results.append(result)
+            else:
+                for local_path, part_path, result in zip(
+                        local_paths, targets, batch_results):
+                    if result is None:
+                        try:
+                            os.replace(part_path, local_path)
+                        except OSError as e:
+                            result = e
+                    if result is not None:
+                        remove_file(part_path)
+                    results.append(result)
+
+            if callback is not None:
+                callback(len(batch))
+
+        return results
 
     def download_tree(self, sub_path, local_prefix):
         # type: (str, str) -> bool
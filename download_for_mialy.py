@@ -2,11 +2,17 @@
 metadata) for further analysis processing of the Google Cloud Storage output
 from one or more wcEcoli sim workflow runs."""
 
+import argparse
+import concurrent.futures as cf
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
 import os
 import time
-from typing import List
+from typing import List, Optional
 
 from analysis.download import DownloadSims
+from analysis.storage import CloudStorage
 
 
 BUCKET = 'sisyphus-mialydefelice-2'
@@ -26,17 +32,53 @@ LOCAL_MASTER = 'master_branch'
 LOCAL_OPERON = 'operon_branch'
 
 
-def download_workflows(bucket: str, workflows: List[str], to_local_dir: str) -> int:
+def init_logging(log_queue: multiprocessing.Queue, verbose: bool) -> None:
+    """Route this process's log records through log_queue so worker threads
+    and processes just enqueue them and one QueueListener thread formats and
+    writes them. verbose logs each downloaded file."""
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    if verbose:
+        logging.getLogger('analysis').setLevel(logging.DEBUG)
+
+
+def download_workflows(bucket: str, workflows: List[str], to_local_dir: str,
+                       storage: Optional[CloudStorage] = None,
+                       refresh: bool = False,
+                       use_grpc: bool = False,
+                       first_position: int = 0) -> int:
+    """Download the workflows concurrently, overlapping their listing and
+    download phases. They run in threads to share one CloudStorage. Their
+    progress bars go on separate terminal lines starting at first_position.
+    The last workflow saves the files they share in to_local_dir, as when
+    they ran in series."""
+    if not workflows:
+        return 0
+
     to_local_dir = os.path.join(to_local_dir, '')
+    storage = storage or CloudStorage(bucket, use_grpc=use_grpc)
     start_secs = time.monotonic()
     count = 0
 
-    for workflow in workflows:
+    def download_workflow(workflow: str, position: int,
+                          shared_files: bool) -> int:
         ds = DownloadSims(bucket=bucket,
                           wcm_workflow_name=workflow,
                           variant_name=VARIANT,
-                          local_dir=to_local_dir)
-        count += ds.download_all_needed_files()
+                          local_dir=to_local_dir,
+                          storage=storage,
+                          refresh=refresh,
+                          progress_position=position,
+                          shared_files=shared_files)
+        return ds.download_all_needed_files()
+
+    with cf.ThreadPoolExecutor(max_workers=len(workflows)) as executor:
+        futures = [executor.submit(download_workflow, w, first_position + i,
+                                   i == len(workflows) - 1)
+                   for i, w in enumerate(workflows)]
+        for future in cf.as_completed(futures):
+            count += future.result()
 
     elapsed_secs = time.monotonic() - start_secs
     if len(workflows) > 1:
@@ -44,21 +86,72 @@ def download_workflows(bucket: str, workflows: List[str], to_local_dir: str) ->
     return count
 
 
-def download_master_workflows():
-    download_workflows(BUCKET, MASTER_WORKFLOWS, LOCAL_MASTER)
+def download_master_workflows(storage: Optional[CloudStorage] = None,
+                              refresh: bool = False,
+                              use_grpc: bool = False) -> int:
+    return download_workflows(
+        BUCKET, MASTER_WORKFLOWS, LOCAL_MASTER, storage, refresh, use_grpc)
 
 
-def download_operon_workflows():
-    download_workflows(BUCKET, OPERON_WORKFLOWS, LOCAL_OPERON)
+def download_operon_workflows(storage: Optional[CloudStorage] = None,
+                              refresh: bool = False,
+                              use_grpc: bool = False) -> int:
+    return download_workflows(
+        BUCKET, OPERON_WORKFLOWS, LOCAL_OPERON, storage, refresh, use_grpc,
+        first_position=len(MASTER_WORKFLOWS))
 
 
-def download_all():
-    download_master_workflows()
+def download_all(refresh: bool = False,
+                 log_queue: Optional[multiprocessing.Queue] = None,
+                 verbose: bool = False,
+                 use_grpc: bool = False):
+    """Download the master and operon workflows in parallel processes, each
+    making its own CloudStorage since a GCS Client isn't picklable. If given a
+    log_queue, the processes send their log records to it."""
+    start_secs = time.monotonic()
+    count = 0
 
-    print('\n' + 80 * '-')
+    initializer, initargs = None, ()
+    if log_queue is not None:
+        initializer, initargs = init_logging, (log_queue, verbose)
 
-    download_operon_workflows()
+    with cf.ProcessPoolExecutor(
+            max_workers=2, initializer=initializer, initargs=initargs) as executor:
+        futures = [
+            executor.submit(
+                download_master_workflows, refresh=refresh, use_grpc=use_grpc),
+            executor.submit(
+                download_operon_workflows, refresh=refresh, use_grpc=use_grpc)]
+        for future in cf.as_completed(futures):
+            count += future.result()
+
+    elapsed_secs = time.monotonic() - start_secs
+    print(80 * '-')
+    print(f'==== Downloaded {count} files in all in {elapsed_secs:1.1f} seconds')
 
 
 if __name__ == '__main__':
-    download_all()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='Re-list the successful sim seeds instead of reading them from'
+             ' the local cache files.')
+    parser.add_argument(
+        '--verbose', '-v', action='store_true',
+        help='Log each downloaded file.')
+    parser.add_argument(
+        '--grpc', action='store_true',
+        help='Download single small files (metadata.json and the serial'
+             ' retries) via the GCS gRPC API. The bulk downloads still use the'
+             ' JSON API. Needs the google-cloud-storage[grpc] extra.')
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, logging.StreamHandler())
+    listener.start()
+    init_logging(queue, args.verbose)
+    try:
+        download_all(refresh=args.refresh, log_queue=queue, verbose=args.verbose,
+                     use_grpc=args.grpc)
+    finally:
+        listener.stop()